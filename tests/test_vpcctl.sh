@@ -5,8 +5,10 @@
 set -e  # Exit immediately if a command fails
 
 SCRIPT="./vpcctl.py"
-VPC1="demo-vpc1"
-VPC2="demo-vpc2"
+VPC1="demovpc1"
+VPC2="demovpc2"
+VPC3="demovpc3"
+TOPOLOGY="./tests/topology.json"
 
 echo "=========================================="
 echo "🚀 Starting VPC Simulator Test Sequence..."
@@ -22,23 +24,45 @@ echo "[TEST] Adding subnets..."
 sudo $SCRIPT --add-subnet $VPC1 subnetA 10.0.1.0/24 public
 sudo $SCRIPT --add-subnet $VPC2 subnetB 10.1.1.0/24 private
 
-# --- Step 3: Peer the VPCs ---
+# --- Step 3: Pre-warm namespaces and add subnets from a topology ---
+echo "[TEST] Adding subnets from topology with a pre-warmed namespace pool..."
+sudo $SCRIPT --prewarm-netns 2
+sudo $SCRIPT --add-topology $TOPOLOGY
+ip -n $VPC1-web addr show | grep -q "10.0.2.2/24"
+ip -n $VPC1-db addr show | grep -q "10.0.3.2/24"
+ip -n $VPC2-web addr show | grep -q "10.1.2.2/24"
+if ip netns list | grep -q "^_pool-"; then
+    echo "[FAIL] Pre-warmed namespaces were not claimed"
+    exit 1
+fi
+
+# --- Step 4: Peer the VPCs ---
 echo "[TEST] Peering VPCs..."
 sudo $SCRIPT --peer-vpcs $VPC1 $VPC2
 
-# --- Step 4: Apply firewall/security policy ---
+# --- Step 5: Apply firewall/security policy ---
 echo "[TEST] Applying firewall policy..."
 sudo $SCRIPT --apply-policy ./policies/sg_policy.json
 
-# --- Step 5: Validate namespaces and bridges ---
+# --- Step 6: Validate namespaces and bridges ---
 echo "[TEST] Verifying environment..."
 ip netns list
-brctl show
+ip link show type bridge
 
-# --- Step 6: Cleanup ---
+# --- Step 7: Cleanup ---
 echo "[TEST] Cleaning up..."
 sudo $SCRIPT --cleanup
 
+# --- Step 8: Emit a provisioning script and run it ---
+echo "[TEST] Emitting and running a provisioning script..."
+EMITTED=$(mktemp)
+sudo $SCRIPT --emit-script --create-vpc $VPC3 10.2.0.0/16 > $EMITTED
+sudo $SCRIPT --emit-script --add-subnet $VPC3 subnetC 10.2.1.0/24 private | tail -n +3 >> $EMITTED
+sudo sh $EMITTED
+ip -n $VPC3-subnetC addr show | grep -q "10.2.1.2/24"
+sudo $SCRIPT --cleanup
+rm -f $EMITTED
+
 echo "=========================================="
 echo "✅ Test sequence completed successfully!"
 echo "=========================================="
@@ -13,52 +13,413 @@ Simulates AWS-like VPC components using Linux networking tools:
 """
 
 import argparse
+import ctypes
+import ctypes.util
+import errno
+import functools
+import ipaddress
+import os
+import re
+import shlex
+import shutil
 import subprocess
 import json
+import logging
 import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from pyroute2 import IPRoute, NetlinkError
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # optional: faster parsing of large policy/topology files
+    _loads = json.loads
+
+# One logger, one write() per line
+log = logging.getLogger("vpcctl")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("%(message)s"))
+log.addHandler(_handler)
+log.setLevel(logging.INFO)
+log.propagate = False
+
+# Characters stripped from interface name parts
+_STRIP = str.maketrans("", "", "-_")
+
+# Namespace creation is serialized by a global kernel lock (net_mutex /
+# pernet_ops_rwsem), so more than ~4 parallel subnet workers gives
+# diminishing returns.
+TOPOLOGY_WORKERS = 4
+
+# Serializes gateway assignment on shared VPC bridges
+_GATEWAY_LOCK = threading.Lock()
+
+# VPC and subnet names: "<vpc>-br" must fit the 15-character interface limit,
+# and no '-' so that "<vpc>-" unambiguously prefixes a VPC's namespaces
+NAME_RE = re.compile(r"\A[A-Za-z0-9]{1,12}\Z")
+
+NETNS_DIR = "/var/run/netns"
+
+# Pre-created namespaces waiting to be claimed by add_subnet. NAME_RE never
+# produces a leading '_', so no subnet namespace can be mistaken for one.
+POOL_PREFIX = "_pool-"
+_POOL_LOCK = threading.Lock()
+
+# mount(2) / umount2(2) / setns(2) flags
+MS_BIND = 4096
+MNT_DETACH = 2
+CLONE_NEWNET = 0x40000000
+_LIBC = None
+
+# One IPRoute object for this CLI invocation (pyroute2 opens one socket per thread)
+_IPR = None
+_IPR_LOCK = threading.Lock()
+
+# With --emit-script, commands are written here as a shell script instead of run
+_EMIT = None
 
 # ==========================================================
 # UTILITY FUNCTIONS
 # ==========================================================
-def run(cmd, check=True):
-    """Execute a shell command with logging and error handling."""
-    print(f"[CMD] {cmd}")
+def emit_to(stream):
+    """Write every command to `stream` as a shell script instead of executing it."""
+    global _EMIT
+    _EMIT = stream
+    _handler.setStream(sys.stderr)
+    stream.write("#!/bin/sh\nset -e\n")
+
+def emit(cmd_str, check=True, input=None):
+    """Append one command (stdin as a here-document) to the emitted script."""
+    line = cmd_str
+    if input is not None:
+        line += " <<'EOF'"
+    if not check:
+        line += " || true"
+    _EMIT.write(line + "\n")
+    if input is not None:
+        _EMIT.write(input if input.endswith("\n") else input + "\n")
+        _EMIT.write("EOF\n")
+
+def spawn(argv, capture=True):
+    """
+    Run an argv list via posix_spawn(2), skipping subprocess.Popen's setup.
+    stdout and stderr are merged and returned when `capture`, else discarded.
+    """
+    if capture:
+        r, w = os.pipe()
+        actions = [(os.POSIX_SPAWN_DUP2, w, 1), (os.POSIX_SPAWN_DUP2, w, 2)]
+    else:
+        actions = [
+            (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+            (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0),
+        ]
+    try:
+        pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=actions)
+    except OSError:
+        if capture:
+            os.close(r)
+        raise
+    finally:
+        if capture:
+            os.close(w)
+    output = ""
+    if capture:
+        with os.fdopen(r, "rb") as f:
+            output = f.read().decode(errors="replace")
+    _, status = os.waitpid(pid, 0)
+    return subprocess.CompletedProcess(argv, os.waitstatus_to_exitcode(status), output, "")
+
+def run(cmd, check=True, input=None, verbose=True):
+    """
+    Execute a command with logging and error handling.
+    `cmd` is an argv list (run without a shell) or, for legacy callers, a
+    shell string. Argv commands without stdin input go through spawn().
+    With verbose=False the command's output is discarded by the kernel
+    instead of being captured and logged.
+    """
+    shell = isinstance(cmd, str)
+    cmd_str = cmd if shell else shlex.join(cmd)
+    log.info(f"[CMD] {cmd_str}")
+    if input is not None:
+        for line in input.splitlines():
+            log.info(f"      {line}")
+    if _EMIT is not None:
+        emit(cmd_str, check=check, input=input)
+        return subprocess.CompletedProcess(cmd, 0, "", "")
     try:
-        result = subprocess.run(cmd, shell=True, check=check, capture_output=True, text=True)
-        if result.stdout.strip():
-            print(result.stdout.strip())
-        if result.stderr.strip():
-            print(result.stderr.strip())
-        return result
-    except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Command failed: {cmd}\n{e.stderr}")
+        if shell or input is not None:
+            if verbose:
+                streams = {"capture_output": True}
+            else:
+                streams = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+            result = subprocess.run(cmd, shell=shell, text=True, input=input, **streams)
+        else:
+            result = spawn(cmd, capture=verbose)
+    except OSError as e:
+        result = subprocess.CompletedProcess(cmd, 127, "", str(e))
+    if verbose and result.stdout.strip():
+        log.info(result.stdout.strip())
+    if verbose and result.stderr.strip():
+        log.info(result.stderr.strip())
+    if result.returncode != 0 and check:
+        log.error(f"[ERROR] Command failed: {cmd_str}")
+        sys.exit(1)
+    return result
+
+def libc():
+    """Return the C library handle (for syscalls the os module doesn't wrap)."""
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _LIBC
+
+def get_ipr():
+    """Return the process-wide IPRoute object, creating it on first use."""
+    global _IPR
+    with _IPR_LOCK:
+        if _IPR is None:
+            _IPR = IPRoute()
+    return _IPR
+
+def close_ipr():
+    """Close the IPRoute object if it was created."""
+    global _IPR
+    with _IPR_LOCK:
+        if _IPR is not None:
+            _IPR.close()
+            _IPR = None
+
+def ifindex(name, ipr=None):
+    """Resolve an interface name to its index (via get_ipr() by default)."""
+    idx = (ipr or get_ipr()).link_lookup(ifname=name)
+    if not idx:
+        raise NetlinkError(errno.ENODEV, f'Cannot find device "{name}"')
+    return idx[0]
+
+def netlink(cmd, request, check=True):
+    """
+    Issue a request through get_ipr() with logging and error handling.
+    `cmd` is the equivalent `ip` command (used for logging), `request` a callable
+    taking the IPRoute socket.
+    """
+    log.info(f"[NETLINK] ip {cmd}")
+    if _EMIT is not None:
+        emit(f"ip {cmd}", check=check)
+        return None
+    try:
+        return request(get_ipr())
+    except NetlinkError as e:
         if check:
+            log.error(f"[ERROR] Netlink request failed: ip {cmd}\n{e}")
             sys.exit(1)
+        log.info(e.args[-1])
         return e
 
+def netlink_in_ns(ns, requests, check=True):
+    """
+    Issue netlink requests inside namespace `ns`. A short-lived thread
+    setns()es into the namespace (which only affects that thread) and opens
+    its own netlink socket there, so no `ip` binary is exec'd and nothing is
+    forked. `requests` is a list of (cmd, request) pairs as taken by
+    netlink(); each request gets the in-namespace IPRoute socket.
+    """
+    for cmd, _ in requests:
+        log.info(f"[NETLINK] ip -n {ns} {cmd}")
+    if _EMIT is not None:
+        for cmd, _ in requests:
+            emit(f"ip -n {ns} {cmd}", check=check)
+        return True
+    errors = []
+
+    def apply():
+        step = f"setns into namespace {ns}"
+        try:
+            fd = os.open(os.path.join(NETNS_DIR, ns), os.O_RDONLY)
+            try:
+                if libc().setns(fd, CLONE_NEWNET) != 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            finally:
+                os.close(fd)
+            with IPRoute() as ipr:
+                for cmd, request in requests:
+                    step = f"ip -n {ns} {cmd}"
+                    request(ipr)
+        except (OSError, NetlinkError) as e:
+            errors.append(f"{step}\n{e}")
+
+    worker = threading.Thread(target=apply, name=f"netns-{ns}")
+    worker.start()
+    worker.join()
+    if errors:
+        log.error(f"[ERROR] Netlink request failed: {errors[0]}")
+        if check:
+            sys.exit(1)
+        return False
+    return True
+
+def run_batch(cmds, check=True, verbose=True):
+    """
+    Execute a list of `ip` commands (without the leading 'ip') in a single
+    `ip -batch` process, sharing one fork/exec and one netlink socket.
+    With check=False the batch runs with -force and continues past errors.
+    """
+    cmd = ["ip", "-batch", "-"] if check else ["ip", "-force", "-batch", "-"]
+    return run(cmd, check=check, input="\n".join(cmds) + "\n", verbose=verbose)
+
+@functools.lru_cache(maxsize=None)
 def exists_ns(ns):
-    """Check if a network namespace exists."""
-    result = subprocess.run(f"ip netns list | grep -w {ns}", shell=True, capture_output=True, text=True)
-    return ns in result.stdout
+    """
+    Check if a network namespace exists (same lookup `ip netns list` performs).
+    Cached per invocation; call exists_ns.cache_clear() after adding/removing one.
+    """
+    return os.path.exists(os.path.join(NETNS_DIR, ns))
 
+@functools.lru_cache(maxsize=None)
 def exists_bridge(bridge):
-    """Check if a bridge exists."""
-    result = subprocess.run(f"brctl show | grep -w {bridge}", shell=True, capture_output=True, text=True)
-    return bridge in result.stdout
+    """
+    Check if a bridge exists (a single stat of its sysfs bridge directory).
+    Cached per invocation; call exists_bridge.cache_clear() after adding/removing one.
+    """
+    return os.path.isdir(f"/sys/class/net/{bridge}/bridge")
+
+def invalid_names(*names):
+    """Return the names that are not valid VPC/subnet names."""
+    return [name for name in names if not NAME_RE.match(name)]
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
+
+def list_netns(prefix=""):
+    """List named network namespaces (the entries `ip netns list` reads) starting with `prefix`."""
+    try:
+        with os.scandir(NETNS_DIR) as it:
+            return [entry.name for entry in it if entry.name.startswith(prefix)]
+    except FileNotFoundError:
+        return []
+
+def list_bridges():
+    """List the names of all bridge interfaces in one netlink dump."""
+    bridges = []
+    for link in get_ipr().get_links():
+        info = link.get_attr("IFLA_LINKINFO")
+        if info is not None and info.get_attr("IFLA_INFO_KIND") == "bridge":
+            bridges.append(link.get_attr("IFLA_IFNAME"))
+    return bridges
+
+def namespace_mounts():
+    """Return the mount points of network namespace bind mounts."""
+    mounts = set()
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            fields = line.split()
+            fstype = fields[fields.index("-") + 1]
+            if fstype in ("nsfs", "proc"):  # "proc" on kernels before 3.19
+                mounts.add(fields[4])
+    return mounts
+
+def pool_entries():
+    """
+    List usable pool namespaces, removing entries that are not namespace mounts
+    (with --emit-script, the removal is written to the script instead).
+    """
+    mounts = namespace_mounts()
+    entries = []
+    for name in sorted(list_netns(POOL_PREFIX)):
+        path = os.path.join(NETNS_DIR, name)
+        if os.path.realpath(path) in mounts:
+            entries.append(name)
+            continue
+        log.warning(f"[WARN] Dropping stale pool entry {name} (not a namespace mount).")
+        if _EMIT is not None:
+            # Leave the host untouched; the script removes it before re-creating it
+            emit(shlex.join(["rm", "-f", path]))
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return entries
+
+def claim_pooled_netns(ns):
+    """
+    Turn a pre-warmed pool namespace into `ns`, skipping namespace creation.
+    Pool entries are bind mounts, which rename(2) refuses (EBUSY), so the
+    namespace is bind-mounted onto the new name and the pool name detached.
+    Entries that are not namespace mounts are removed from the pool.
+    Returns False when the pool is empty or the handover fails.
+    """
+    if _EMIT is not None:
+        return False
+    with _POOL_LOCK:
+        pool = pool_entries()
+        if not pool:
+            return False
+        name = pool[0]
+        src = os.path.join(NETNS_DIR, name).encode()
+        dst = os.path.join(NETNS_DIR, ns).encode()
+        log.info(f"[INFO] Claiming pre-warmed namespace {name} as {ns}")
+        try:
+            os.close(os.open(dst, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0))
+        except OSError as e:
+            log.warning(f"[WARN] Could not claim {name}: {e}")
+            return False
+        if libc().mount(src, dst, None, MS_BIND, None) != 0:
+            err = ctypes.get_errno()
+            os.unlink(dst)
+            log.warning(f"[WARN] Could not claim {name}: mount failed: {os.strerror(err)}")
+            return False
+        if libc().umount2(src, MNT_DETACH) != 0:
+            err = ctypes.get_errno()
+            libc().umount2(dst, MNT_DETACH)
+            os.unlink(dst)
+            log.warning(f"[WARN] Could not claim {name}: umount failed: {os.strerror(err)}")
+            return False
+        os.unlink(src)
+        return True
 
 def cleanup_veth(veth_name):
     """Remove a veth interface if it exists (idempotent)."""
-    run(f"ip link del {veth_name}", check=False)
+    netlink(f"link del {veth_name}", lambda ipr: ipr.link("del", index=ifindex(veth_name)), check=False)
+
+def cleanup_legacy_veth(veth_name, bridge):
+    """
+    Remove a veth named by older vpcctl versions (see legacy_short_name), but
+    only if it is enslaved to `bridge`: a legacy name can equal the current
+    name of another VPC/subnet's veth, which must be left alone.
+    """
+    ipr = get_ipr()
+    link_idx = ipr.link_lookup(ifname=veth_name)
+    bridge_idx = ipr.link_lookup(ifname=bridge)
+    if not link_idx or not bridge_idx:
+        return
+    if ipr.get_links(link_idx[0])[0].get_attr("IFLA_MASTER") != bridge_idx[0]:
+        return
+    cleanup_veth(veth_name)
 
+@functools.lru_cache(maxsize=512)
 def short_name(prefix, *parts, max_len=15):
     """
     Generate a short, valid Linux interface name.
     - Keeps total name length <= 15 characters.
     - Removes unsupported characters like '-' or '_'.
+    - Ends with a short hash of the parts so names sharing a prefix stay unique.
     """
-    safe_parts = "".join(p.replace("-", "")[:4] for p in parts)
-    name = f"{prefix}{safe_parts}"[:max_len]
-    return name
+    tag = f"{zlib.crc32('/'.join(parts).encode()) & 0xffff:04x}"
+    return (prefix + "".join(p.translate(_STRIP)[:4] for p in parts))[:max_len - len(tag)] + tag
+
+def legacy_short_name(prefix, *parts, max_len=15):
+    """Interface name used before short_name() gained its hash suffix."""
+    return (prefix + "".join(p.replace("-", "")[:4] for p in parts))[:max_len]
 
 # ==========================================================
 # CORE FUNCTIONS
@@ -66,29 +427,32 @@ def short_name(prefix, *parts, max_len=15):
 def create_vpc(vpc_name, cidr_block):
     """Create a new VPC represented as a Linux bridge."""
     bridge = f"{vpc_name}-br"
-    print(f"[INFO] Creating VPC '{vpc_name}' with bridge '{bridge}' and CIDR {cidr_block}")
+    log.info(f"[INFO] Creating VPC '{vpc_name}' with bridge '{bridge}' and CIDR {cidr_block}")
     if not exists_bridge(bridge):
-        run(f"ip link add name {bridge} type bridge")
-        run(f"ip link set {bridge} up")
-        print(f"[SUCCESS] VPC '{vpc_name}' created.")
+        netlink(f"link add name {bridge} up type bridge",
+                lambda ipr: ipr.link("add", ifname=bridge, kind="bridge", state="up"))
+        exists_bridge.cache_clear()
+        log.info(f"[SUCCESS] VPC '{vpc_name}' created.")
     else:
-        print(f"[INFO] Bridge {bridge} already exists — skipping creation.")
+        log.info(f"[INFO] Bridge {bridge} already exists — skipping creation.")
 
 def delete_vpc(vpc_name):
     """Delete a VPC and its connected namespaces and interfaces."""
     bridge = f"{vpc_name}-br"
-    print(f"[INFO] Deleting VPC '{vpc_name}' and associated resources...")
-    result = subprocess.run("ip netns list", shell=True, capture_output=True, text=True)
-    for ns in result.stdout.strip().split("\n"):
-        if ns.startswith(vpc_name):
-            print(f"[INFO] Removing namespace {ns}")
-            run(f"ip netns delete {ns}", check=False)
+    log.info(f"[INFO] Deleting VPC '{vpc_name}' and associated resources...")
+    # The '-' keeps "vpc1" from matching "vpc10-..." namespaces
+    targets = list_netns(f"{vpc_name}-")
+    for ns in targets:
+        log.info(f"[INFO] Removing namespace {ns}")
+    if targets:
+        run_batch([f"netns del {ns}" for ns in targets], check=False, verbose=False)
+        exists_ns.cache_clear()
     if exists_bridge(bridge):
-        run(f"ip link set {bridge} down", check=False)
-        run(f"ip link del {bridge}", check=False)
-        print(f"[SUCCESS] VPC '{vpc_name}' deleted successfully.")
+        netlink(f"link del {bridge}", lambda ipr: ipr.link("del", index=ifindex(bridge)), check=False)
+        exists_bridge.cache_clear()
+        log.info(f"[SUCCESS] VPC '{vpc_name}' deleted successfully.")
     else:
-        print(f"[WARN] Bridge {bridge} not found — skipping deletion.")
+        log.warning(f"[WARN] Bridge {bridge} not found — skipping deletion.")
 
 def add_subnet(vpc_name, subnet_name, cidr, subnet_type="private"):
     """Add a subnet (namespace) and attach it to a VPC bridge with proper gateway."""
@@ -99,46 +463,115 @@ def add_subnet(vpc_name, subnet_name, cidr, subnet_type="private"):
     veth_host = short_name("vh", vpc_name, subnet_name)
     veth_ns = short_name("vn", vpc_name, subnet_name)
 
-    print(f"[INFO] Adding subnet '{subnet_name}' ({subnet_type}) with CIDR {cidr}")
+    log.info(f"[INFO] Adding subnet '{subnet_name}' ({subnet_type}) with CIDR {cidr}")
 
-    # Ensure namespace exists
-    if not exists_ns(ns):
-        run(f"ip netns add {ns}")
-    else:
-        print(f"[INFO] Namespace {ns} already exists.")
+    # An emitted script may create the bridge in an earlier step
+    if not exists_bridge(bridge) and _EMIT is None:
+        log.error(f"[ERROR] VPC '{vpc_name}' not found (bridge {bridge} missing).")
+        sys.exit(1)
 
-    # Delete old veth if exists
+    # Parse the CIDR once; gateway and host take the first two usable addresses
+    try:
+        net = ipaddress.IPv4Network(cidr, strict=False)
+    except ValueError as e:
+        log.error(f"[ERROR] Invalid CIDR {cidr}: {e}")
+        sys.exit(1)
+    if net.prefixlen > 30:
+        log.error(f"[ERROR] CIDR {cidr} is too small for a gateway and a host (need /30 or larger).")
+        sys.exit(1)
+    gateway_ip, host_ip, prefix = net.network_address + 1, net.network_address + 2, net.prefixlen
+
+    # Delete old veth if exists (including one named by older vpcctl versions)
     cleanup_veth(veth_host)
+    cleanup_legacy_veth(legacy_short_name("vh", vpc_name, subnet_name), bridge)
 
-    # Create veth pair
-    run(f"ip link add {veth_host} type veth peer name {veth_ns}")
-    run(f"ip link set {veth_host} master {bridge}")
-    run(f"ip link set {veth_host} up")
-    run(f"ip link set {veth_ns} netns {ns}")
-    run(f"ip netns exec {ns} ip link set {veth_ns} up")
+    # Ensure namespace exists, taking one from the pre-warmed pool if possible
+    if not exists_ns(ns):
+        if not claim_pooled_netns(ns):
+            run(["ip", "netns", "add", ns])
+        exists_ns.cache_clear()
+    else:
+        log.info(f"[INFO] Namespace {ns} already exists.")
 
-    # Calculate gateway and host IPs
-    base_ip = cidr.split("/")[0]          # e.g., "10.0.1.0"
-    octets = base_ip.split(".")
-    gateway_ip = f"{octets[0]}.{octets[1]}.{octets[2]}.1"
-    host_ip = f"{octets[0]}.{octets[1]}.{octets[2]}.2"
+    # Create veth pair and move its peer into the namespace
+    netlink(f"link add {veth_host} type veth peer name {veth_ns}",
+            lambda ipr: ipr.link("add", ifname=veth_host, kind="veth", peer=veth_ns))
+    netlink(f"link set {veth_host} master {bridge} up",
+            lambda ipr: ipr.link("set", index=ifindex(veth_host), master=ifindex(bridge), state="up"))
+    netlink(f"link set {veth_ns} netns {ns}",
+            lambda ipr: ipr.link("set", index=ifindex(veth_ns), net_ns_fd=ns))
 
-    # Assign gateway IP to bridge if not already assigned
-    run(f"ip addr add {gateway_ip}/{cidr.split('/')[1]} dev {bridge}", check=False)
+    # Assign gateway IP to bridge (replace keeps re-runs idempotent)
+    with _GATEWAY_LOCK:
+        netlink(f"addr replace {gateway_ip}/{prefix} dev {bridge}",
+                lambda ipr: ipr.addr("replace", index=ifindex(bridge), address=str(gateway_ip), prefixlen=prefix))
 
-    # Assign IP to namespace veth
-    run(f"ip netns exec {ns} ip addr add {host_ip}/{cidr.split('/')[1]} dev {veth_ns}")
+    # Bring up the namespace side, assign its IP and set the default route
+    netlink_in_ns(ns, [
+        (f"link set {veth_ns} up",
+         lambda ipr: ipr.link("set", index=ifindex(veth_ns, ipr), state="up")),
+        (f"addr add {host_ip}/{prefix} dev {veth_ns}",
+         lambda ipr: ipr.addr("add", index=ifindex(veth_ns, ipr), address=str(host_ip), prefixlen=prefix)),
+        (f"route add default via {gateway_ip}",
+         lambda ipr: ipr.route("add", dst="0.0.0.0/0", gateway=str(gateway_ip))),
+    ])
 
-    # Set default route in namespace
-    run(f"ip netns exec {ns} ip route add default via {gateway_ip}")
+    log.info(f"[SUCCESS] Subnet '{subnet_name}' added successfully to VPC '{vpc_name}'.")
 
-    print(f"[SUCCESS] Subnet '{subnet_name}' added successfully to VPC '{vpc_name}'.")
+def prewarm_netns(count):
+    """Create a pool of empty namespaces for later add_subnet calls to claim."""
+    with _POOL_LOCK:
+        existing = set(pool_entries())
+    names = [f"{POOL_PREFIX}{i}" for i in range(count) if f"{POOL_PREFIX}{i}" not in existing]
+    log.info(f"[INFO] Pre-warming {len(names)} network namespace(s)")
+    if names:
+        run_batch([f"netns add {name}" for name in names])
+    log.info(f"[SUCCESS] Namespace pool holds {count} namespace(s).")
+
+def add_topology(topology_file, max_workers=TOPOLOGY_WORKERS):
+    """Add every subnet listed in a JSON topology file, several at a time."""
+    log.info(f"[INFO] Applying topology from {topology_file}")
+    with open(topology_file, "rb") as f:
+        try:
+            subnets = _loads(f.read())
+        except ValueError as e:  # json and orjson decode errors are ValueErrors
+            log.error(f"[ERROR] Could not parse topology '{topology_file}': {e}")
+            sys.exit(1)
+    if not isinstance(subnets, list):
+        log.error("[ERROR] Topology must be a JSON list of subnet objects.")
+        sys.exit(1)
+    malformed = [
+        i for i, s in enumerate(subnets)
+        if not isinstance(s, dict) or not all(isinstance(s.get(k), str) for k in ("vpc", "subnet", "cidr"))
+    ]
+    if malformed:
+        log.error(f"[ERROR] Topology entries missing string 'vpc', 'subnet' or 'cidr': "
+                  f"{', '.join(f'#{i}' for i in malformed)}")
+        sys.exit(1)
+    bad = invalid_names(*(name for s in subnets for name in (s["vpc"], s["subnet"])))
+    if bad:
+        log.error(f"[ERROR] Invalid name(s) in topology: {', '.join(bad)}")
+        sys.exit(1)
+    # Emitted scripts must stay in order, so they are generated serially
+    if _EMIT is not None:
+        max_workers = 1
+    else:
+        get_ipr()  # create the IPRoute object before the workers start using it
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(add_subnet, s["vpc"], s["subnet"], s["cidr"], s.get("type", "private"))
+            for s in subnets
+        ]
+        for future in futures:
+            future.result()
+    log.info(f"[SUCCESS] {len(subnets)} subnet(s) added from topology '{topology_file}'.")
 
 def configure_nat(subnet_ns, internet_iface):
     """Enable NAT for a subnet (public) to access the internet."""
-    print(f"[INFO] Configuring NAT for namespace '{subnet_ns}' via interface '{internet_iface}'")
-    run(f"ip netns exec {subnet_ns} iptables -t nat -A POSTROUTING -o {internet_iface} -j MASQUERADE")
-    print(f"[SUCCESS] NAT configured for '{subnet_ns}'.")
+    log.info(f"[INFO] Configuring NAT for namespace '{subnet_ns}' via interface '{internet_iface}'")
+    run(["ip", "netns", "exec", subnet_ns,
+         "iptables", "-t", "nat", "-A", "POSTROUTING", "-o", internet_iface, "-j", "MASQUERADE"])
+    log.info(f"[SUCCESS] NAT configured for '{subnet_ns}'.")
 
 def peer_vpcs(vpc1, vpc2):
     """Peer two VPCs by connecting their bridges."""
@@ -146,31 +579,59 @@ def peer_vpcs(vpc1, vpc2):
     br2 = f"{vpc2}-br"
     peer0 = short_name("p0", vpc1, vpc2)
     peer1 = short_name("p1", vpc1, vpc2)
-    print(f"[INFO] Creating VPC peering connection between '{vpc1}' and '{vpc2}'")
+    log.info(f"[INFO] Creating VPC peering connection between '{vpc1}' and '{vpc2}'")
     cleanup_veth(peer0)
-    run(f"ip link add {peer0} type veth peer name {peer1}")
-    run(f"ip link set {peer0} master {br1}")
-    run(f"ip link set {peer1} master {br2}")
-    run(f"ip link set {peer0} up")
-    run(f"ip link set {peer1} up")
-    print(f"[SUCCESS] VPCs '{vpc1}' and '{vpc2}' peered successfully.")
+    cleanup_legacy_veth(legacy_short_name("p0", vpc1, vpc2), br1)
+    netlink(f"link add {peer0} type veth peer name {peer1}",
+            lambda ipr: ipr.link("add", ifname=peer0, kind="veth", peer=peer1))
+    netlink(f"link set {peer0} master {br1} up",
+            lambda ipr: ipr.link("set", index=ifindex(peer0), master=ifindex(br1), state="up"))
+    netlink(f"link set {peer1} master {br2} up",
+            lambda ipr: ipr.link("set", index=ifindex(peer1), master=ifindex(br2), state="up"))
+    log.info(f"[SUCCESS] VPCs '{vpc1}' and '{vpc2}' peered successfully.")
+
+def compile_iptables_policy(ingress):
+    """Compile ingress rules into a single iptables-restore document."""
+    lines = [
+        "*filter",
+        ":INPUT ACCEPT [0:0]",
+        ":FORWARD ACCEPT [0:0]",
+        ":OUTPUT ACCEPT [0:0]",
+    ]
+    for rule in ingress:
+        target = "ACCEPT" if rule["action"] == "allow" else "DROP"
+        lines.append(f"-A INPUT -p {rule['protocol']} --dport {rule['port']} -j {target}")
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+def compile_nft_policy(ingress):
+    """Compile ingress rules into a single `nft -f` document."""
+    lines = [
+        "add table inet vpcctl",
+        "add chain inet vpcctl input { type filter hook input priority 0 ; policy accept ; }",
+    ]
+    for rule in ingress:
+        verdict = "accept" if rule["action"] == "allow" else "drop"
+        lines.append(f"add rule inet vpcctl input {rule['protocol']} dport {rule['port']} {verdict}")
+    return "\n".join(lines) + "\n"
 
 def apply_policy(policy_file):
-    """Apply firewall/security rules from a JSON policy file."""
-    print(f"[INFO] Applying policy from {policy_file}")
-    with open(policy_file) as f:
-        policy = json.load(f)
+    """
+    Apply firewall/security rules from a JSON policy file.
+    The whole policy is loaded by one iptables-restore process (or nft, on
+    hosts without iptables) instead of one iptables fork per rule.
+    """
+    log.info(f"[INFO] Applying policy from {policy_file}")
+    with open(policy_file, "rb") as f:
+        policy = _loads(f.read())
     subnet = policy["subnet"]
     ingress = policy.get("ingress", [])
-    for rule in ingress:
-        port = rule["port"]
-        proto = rule["protocol"]
-        action = rule["action"]
-        if action == "allow":
-            run(f"ip netns exec {subnet} iptables -A INPUT -p {proto} --dport {port} -j ACCEPT")
-        else:
-            run(f"ip netns exec {subnet} iptables -A INPUT -p {proto} --dport {port} -j DROP")
-    print(f"[SUCCESS] Security policy applied to subnet '{subnet}'.")
+    if shutil.which("iptables-restore") is None and shutil.which("nft") is not None:
+        run(["ip", "netns", "exec", subnet, "nft", "-f", "-"], input=compile_nft_policy(ingress))
+    else:
+        run(["ip", "netns", "exec", subnet, "iptables-restore", "--noflush"],
+            input=compile_iptables_policy(ingress))
+    log.info(f"[SUCCESS] Security policy applied to subnet '{subnet}'.")
 
 # ==========================================================
 # CLI ENTRYPOINT
@@ -180,29 +641,62 @@ def main():
     parser.add_argument("--create-vpc", nargs=2, metavar=("VPC_NAME", "CIDR_BLOCK"))
     parser.add_argument("--delete-vpc", metavar="VPC_NAME")
     parser.add_argument("--add-subnet", nargs=4, metavar=("VPC_NAME", "SUBNET_NAME", "CIDR", "TYPE"))
+    parser.add_argument("--add-topology", metavar="JSON_FILE")
     parser.add_argument("--peer-vpcs", nargs=2, metavar=("VPC1", "VPC2"))
     parser.add_argument("--apply-policy", metavar="JSON_FILE")
+    parser.add_argument("--prewarm-netns", type=positive_int, metavar="N")
     parser.add_argument("--cleanup", action="store_true")
+    parser.add_argument("--emit-script", action="store_true",
+                        help="print the commands as a shell script instead of running them")
 
     args = parser.parse_args()
 
+    # Validate names once, before anything reaches a command line
+    names = []
     if args.create_vpc:
-        create_vpc(*args.create_vpc)
-    elif args.delete_vpc:
-        delete_vpc(args.delete_vpc)
-    elif args.add_subnet:
-        add_subnet(*args.add_subnet)
-    elif args.peer_vpcs:
-        peer_vpcs(*args.peer_vpcs)
-    elif args.apply_policy:
-        apply_policy(args.apply_policy)
-    elif args.cleanup:
-        print("[INFO] Performing full cleanup of all virtual VPCs and namespaces...")
-        run("ip netns list | xargs -n1 ip netns delete", check=False)
-        run("brctl show | tail -n +2 | awk '{print $1}' | xargs -n1 ip link del", check=False)
-        print("[SUCCESS] Cleanup completed.")
-    else:
-        parser.print_help()
+        names.append(args.create_vpc[0])
+    if args.delete_vpc:
+        names.append(args.delete_vpc)
+    if args.add_subnet:
+        names += args.add_subnet[:2]
+    if args.peer_vpcs:
+        names += args.peer_vpcs
+    bad = invalid_names(*names)
+    if bad:
+        parser.error(f"invalid name(s): {', '.join(bad)} "
+                     "(letters and digits only, at most 12 characters)")
+
+    if args.emit_script:
+        emit_to(sys.stdout)
+
+    try:
+        if args.create_vpc:
+            create_vpc(*args.create_vpc)
+        elif args.delete_vpc:
+            delete_vpc(args.delete_vpc)
+        elif args.add_subnet:
+            add_subnet(*args.add_subnet)
+        elif args.add_topology:
+            add_topology(args.add_topology)
+        elif args.peer_vpcs:
+            peer_vpcs(*args.peer_vpcs)
+        elif args.apply_policy:
+            apply_policy(args.apply_policy)
+        elif args.prewarm_netns is not None:
+            prewarm_netns(args.prewarm_netns)
+        elif args.cleanup:
+            log.info("[INFO] Performing full cleanup of all virtual VPCs and namespaces...")
+            cmds = [f"netns del {ns}" for ns in list_netns()]
+            cmds += [f"link del {br}" for br in list_bridges() if br.endswith("-br")]
+            if cmds:
+                run_batch(cmds, check=False, verbose=False)
+                exists_ns.cache_clear()
+                exists_bridge.cache_clear()
+            log.info("[SUCCESS] Cleanup completed.")
+        else:
+            parser.print_help()
+    finally:
+        close_ipr()
 
 if __name__ == "__main__":
     main()